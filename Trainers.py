@@ -3,8 +3,9 @@ from torch.cuda.amp import GradScaler
 from torch.cuda.amp import autocast
 from sklearn.metrics import r2_score
 import time
-from utils.utils import AverageMeter
-from utils.ddp_utils import is_master, is_dist_avail_and_initialized, AverageMeterDDP
+from contextlib import nullcontext
+from utils.utils import AverageMeter, normalize_uint8_input, autocast_kwargs, memory_format
+from utils.ddp_utils import is_master, is_dist_avail_and_initialized, AverageMeterDDP, AverageMeterGroupDDP
 
 
 class DDPTrainer:
@@ -17,9 +18,15 @@ class DDPTrainer:
         self.device = device
         self.cfg = config
 
-        # Mixed precision
+        # Mixed precision, bf16 has the exponent range of fp32 so the loss is only scaled for fp16
         self.use_half_prec = config.performance.half_precision
-        self.scaler = GradScaler(enabled=self.use_half_prec)
+        self.autocast_kwargs = autocast_kwargs(config)
+        self.scaler = GradScaler(enabled=self.use_half_prec and config.performance.half_precision_dtype == 'fp16')
+
+        # Number of batches the gradients are accumulated over before each optimizer step
+        self.accum_steps = config.training.accum_steps
+
+        self.memory_format = memory_format(config)
 
     def train_epoch(self, model, train_data_loader, optimizer, curr_epoch):
 
@@ -27,46 +34,60 @@ class DDPTrainer:
         data_time_t = AverageMeterDDP()
         loss_values = AverageMeterDDP()
         r2_values = AverageMeterDDP()
+        # All four are reduced together once per batch
+        meters = AverageMeterGroupDDP(batch_time=batch_time_t, data_time=data_time_t, loss=loss_values, r2=r2_values)
 
         model.train()
 
         if is_dist_avail_and_initialized():
             train_data_loader.sampler.set_epoch(curr_epoch)
 
+        n_batches = len(train_data_loader)
+        # The last group of batches is smaller when accum_steps does not divide the number of batches
+        tail_start = n_batches - n_batches % self.accum_steps
+        optimizer.zero_grad()
         end_time_t = time.time()
         for j, (inputs, targets, indexes, _, _) in enumerate(train_data_loader):
-            # Update timer for data retrieval
-            data_time_t.update([time.time() - end_time_t])
+            # Timer for data retrieval
+            batch_values = {'data_time': [time.time() - end_time_t]}
             # Move inputs and targets to correct device
-            if len(inputs) > 1:
+            if isinstance(inputs, list):
                 for p, inp in enumerate(inputs):
                     if not torch.isfinite(inp).all():
                         raise ValueError('Input from dataloader not finite')
-                    inputs[p] = inp.to(self.device, non_blocking=True)
+                    inputs[p] = normalize_uint8_input(inp.to(self.device, non_blocking=True,
+                                                             memory_format=self.memory_format))
             else:
                 if not torch.isfinite(inputs).all():
                     raise ValueError('Input from dataloader not finite')
-                inputs = inputs.to(self.device, non_blocking=True)
+                inputs = normalize_uint8_input(inputs.to(self.device, non_blocking=True,
+                                                         memory_format=self.memory_format))
             targets = targets.to(self.device, non_blocking=True)
 
+            # Step every accum_steps batches and on the last batch, gradients are only allreduced for those
+            step = (j + 1) % self.accum_steps == 0 or j + 1 == n_batches
+            group_size = self.accum_steps if j < tail_start else n_batches - tail_start
+            sync_context = model.no_sync() if not step and hasattr(model, 'no_sync') else nullcontext()
+
             # Do forward and backwards pass
-            # Get model train output and train loss
-            with autocast(enabled=self.use_half_prec):
-                outputs = model(inputs)
-                loss = self.criterion(outputs, targets)
-                loss_mean = loss.mean()
-            if self.cfg.data_loader.weighted_sampler:
-                for index, l in zip(indexes, loss.cpu().detach()):
-                    loss_ratio = l / loss_mean.cpu().detach()
-                    loss_ratio = torch.clamp(loss_ratio, min=0.1, max=3)
-                    train_data_loader.sampler.weights[index] = loss_ratio
-
-            optimizer.zero_grad()
-
-            # Backwards pass
-            self.scaler.scale(loss_mean).backward()
-            self.scaler.step(optimizer)
-            self.scaler.update()
+            with sync_context:
+                # Get model train output and train loss
+                with autocast(enabled=self.use_half_prec, **self.autocast_kwargs):
+                    outputs = model(inputs)
+                    loss = self.criterion(outputs, targets)
+                    loss_mean = loss.mean()
+                if self.cfg.data_loader.weighted_sampler:
+                    for index, l in zip(indexes, loss.cpu().detach()):
+                        loss_ratio = l / loss_mean.cpu().detach()
+                        loss_ratio = torch.clamp(loss_ratio, min=0.1, max=3)
+                        train_data_loader.sampler.weights[index] = loss_ratio
+
+                # Backwards pass
+                self.scaler.scale(loss_mean / group_size).backward()
+            if step:
+                self.scaler.step(optimizer)
+                self.scaler.update()
+                optimizer.zero_grad()
 
             # Calculate and update metrics
             try:
@@ -75,13 +96,14 @@ class DDPTrainer:
                 metric_targets = targets.cpu().detach().numpy()
                 metric_outputs = outputs.cpu().detach().numpy()
                 metric_r2 = r2_score(metric_targets, metric_outputs)
-                r2_values.update([metric_r2])
-                loss_values.update([loss_mean])
+                batch_values['r2'] = [metric_r2]
+                batch_values['loss'] = [loss_mean.item()]
             except ValueError as ve:
                 print('Failed to calculate with error: {} and output: {}'.format(ve, outputs))
 
-            # Update timer for batch
-            batch_time_t.update([time.time() - end_time_t])
+            # Timer for batch
+            batch_values['batch_time'] = [time.time() - end_time_t]
+            meters.update(batch_values)
 
             if j % 100 == 0 and is_master():
                 print('Training Batch: [{}/{}] in epoch: {} \t '
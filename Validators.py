@@ -4,7 +4,7 @@ import numpy as np
 import pandas as pd
 import time
 from sklearn.metrics import r2_score
-from utils.utils import AverageMeter
+from utils.utils import AverageMeter, normalize_uint8_input, autocast_kwargs, memory_format
 from utils.ddp_utils import is_master
 
 
@@ -15,6 +15,9 @@ class DDPValidator:
         self.cfg = config
 
         self.use_half_prec = config.performance.half_precision
+        self.autocast_kwargs = autocast_kwargs(config)
+
+        self.memory_format = memory_format(config)
 
     @torch.no_grad()
     def validate(self, model, val_data_loader, curr_epoch):
@@ -37,16 +40,18 @@ class DDPValidator:
             data_time_v.update(time.time() - end_time_v)
 
             # Move input to correct self.device
-            if len(inputs_v) > 1:
+            if isinstance(inputs_v, list):
                 for p, inp in enumerate(inputs_v):
-                    inputs_v[p] = inp.to(self.device, non_blocking=True)
+                    inputs_v[p] = normalize_uint8_input(inp.to(self.device, non_blocking=True,
+                                                               memory_format=self.memory_format))
             else:
-                inputs_v = inputs_v.to(self.device, non_blocking=True)
+                inputs_v = normalize_uint8_input(inputs_v.to(self.device, non_blocking=True,
+                                                             memory_format=self.memory_format))
             targets_v = targets_v.to(self.device, non_blocking=True)
 
             with torch.no_grad():
                 # Get model validation output and validation loss
-                with autocast(enabled=self.use_half_prec):
+                with autocast(enabled=self.use_half_prec, **self.autocast_kwargs):
                     outputs_v = model(inputs_v)
                     loss_v = self.criterion(outputs_v, targets_v)
                     loss_mean_v = loss_v.mean()
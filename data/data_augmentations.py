@@ -1,28 +1,52 @@
 import numpy as np
-from skimage.util import random_noise, img_as_float32, crop
-from skimage.color import rgb2gray
-from skimage.transform import resize, rescale, rotate
-from random import choice, randint
+from random import choice, randint, sample
 import math
+import os
 import time
 from omegaconf import OmegaConf, DictConfig
 import cv2
 
+# Prints the processing time of every step in transform_values and transform_size
+DEBUG = False
+
+# cv2 runs inside the DataLoader workers, its own thread pool would only oversubscribe the cpus
+cv2.setNumThreads(0)
+
+
+def init_worker(worker_id):
+    '''
+    DataLoader worker_init_fn. Keeps cv2 in every worker to a single thread, the workers already run in parallel.
+    The DataLoader itself already limits torch to one thread per worker.
+    :param worker_id: Id of the DataLoader worker, not used
+    '''
+    cv2.setNumThreads(0)
+
+
+# Number of standard normal noise arrays kept for gaussian and speckle noise
+NOISE_POOL_SIZE = 4
+
+# Augmentations in transform_values, they all work on the normalized float image
+VALUE_AUGMENTATIONS = ['gaussian_noise', 'speckle', 'salt_and_pepper', 'translate_h', 'translate_v', 'rotate', 'zoom',
+                       'local_blackout', 'local_intensity']
+
 
 class DataAugmentations:
-    def __init__(self, transforms, augmentations):
+    def __init__(self, transforms, augmentations, return_uint8=False):
         '''
         Class for all transforms and augmentations to be applied.
         Holds configurations on what to apply and methods for
         applying them.
         :param transforms: OmegaConf object for transform settings/flags
         :param augmentations:  OmegaConf object for augmentation settings/flags
+        :param return_uint8: Leave normalization to the training step and return uint8 from transform_values.
+        Ignored if any value augmentations are enabled, as they need the normalized image.
         '''
         super(DataAugmentations).__init__()
         
         self.transforms = transforms
         self.augmentations = augmentations
-        self.debug = False
+        self.return_uint8 = return_uint8 and self.transforms.normalize_input and \
+            not any(self.augmentations.get(a, False) for a in VALUE_AUGMENTATIONS)
 
         if self.transforms.normalize_input:
             self.black_val = -1.0
@@ -30,6 +54,11 @@ class DataAugmentations:
         else:
             self.black_val = 0.0
             self.white_val = 255.0
+        # Noise variances are given for values in range 0:1 (as in skimage.util.random_noise)
+        self.noise_scale = 1.0 if self.transforms.normalize_input else 255.0
+        # Drawn on first use in each process, see get_noise
+        self.noise_pool = None
+        self.noise_pool_pid = None
 
     def transform_values(self, img):
         '''
@@ -37,31 +66,40 @@ class DataAugmentations:
         :param img: Multidimensional input image with values in range 0-255.
         :return: The transformed input.
         '''
-        time_start = time.time()
+        # Samples are 4x smaller as uint8, normalize_uint8_input does the normalization after the move to the gpu
+        if self.return_uint8:
+            return img.astype(np.uint8, copy=False)
+        if DEBUG:
+            time_start = time.time()
         # Pixel values expected to be in range 0-255
+        # All value transforms below work in place on this single float32 copy of the input
         if self.transforms.normalize_input:
             img = self.t_normalize_signed(img)
-        if self.debug:
+        else:
+            img = img.astype(np.float32)
+        if DEBUG:
             time_ni = time.time()
             time_ni_diff = time_ni - time_start
             print("Normalized input. Time to process: {}".format(time_ni_diff))
 
         # Add some kind of noise to the image
-        if self.augmentations.gaussian_noise:
+        if self.augmentations.gaussian_noise and self.augmentations.speckle:
+            img = self.t_gaussian_speckle(img)
+        elif self.augmentations.gaussian_noise:
             img = self.t_gaussian_noise(img)
-        if self.debug:
+        if DEBUG:
             time_gn = time.time()
             time_gn_diff = time_gn - time_ni
             print("Added gaussian noise. Time to process: {}".format(time_gn_diff))
-        if self.augmentations.speckle:
+        if self.augmentations.speckle and not self.augmentations.gaussian_noise:
             img = self.t_speckle(img)
-        if self.debug:
+        if DEBUG:
             time_spk = time.time()
             time_spk_diff = time_spk - time_gn
             print("Added speckle. Time to process: {}".format(time_spk_diff))
         if self.augmentations.salt_and_pepper:
             img = self.t_salt_and_pepper(img)
-        if self.debug:
+        if DEBUG:
             time_sp = time.time()
             time_sp_diff = time_sp - time_spk
             print("Added Salt and Pepper. Time to process: {}".format(time_sp_diff))
@@ -69,25 +107,25 @@ class DataAugmentations:
         # Shift the image in some way
         if self.augmentations.translate_h:
             img = self.t_translate_h(img)
-        if self.debug:
+        if DEBUG:
             time_th = time.time()
             time_th_diff = time_th - time_sp
             print("Translated horizontal. Time to process: {}".format(time_th_diff))
         if self.augmentations.translate_v:
             img = self.t_translate_v(img)
-        if self.debug:
+        if DEBUG:
             time_tv = time.time()
             time_tv_diff = time_tv - time_th
             print("Translated vertical. Time to process: {}".format(time_tv_diff))
         if self.augmentations.rotate:
             img = self.t_rotate(img)
-        if self.debug:
+        if DEBUG:
             time_rot = time.time()
             time_rot_diff = time_rot - time_tv
             print("Rotated frames. Time to process: {}".format(time_rot_diff))
         if self.augmentations.zoom:
             img = self.t_zoom(img)
-        if self.debug:
+        if DEBUG:
             time_zoom = time.time()
             time_zoom_diff = time_zoom - time_rot
             print("Zoomed frames. Time to process: {}".format(time_zoom_diff))
@@ -95,18 +133,18 @@ class DataAugmentations:
         # Local changes
         if self.augmentations.local_blackout:
             img = self.t_local_blackout(img)
-        if self.debug:
+        if DEBUG:
             time_lb = time.time()
             time_lb_diff = time_lb - time_rot
             print("Added local blackout. Time to process: {}".format(time_lb_diff))
         if self.augmentations.local_intensity:
             img = self.t_local_intensity(img)
-        if self.debug:
+        if DEBUG:
             time_li = time.time()
             time_li_diff = time_li - time_lb
             print("Added local intensity. Time to process: {}".format(time_li_diff))
 
-        return img.astype(np.float32)
+        return img.astype(np.float32, copy=False)
 
     def transform_size(self, img, fps, hr, rwaves):
         '''
@@ -117,15 +155,16 @@ class DataAugmentations:
         :return: The transformed image.
         '''
         initial_shape = img.shape
-        time_start = time.time()
+        if DEBUG:
+            time_start = time.time()
         if self.transforms.grayscale:
             img = self.t_grayscale_mean(img)
-        if self.debug:
+        if DEBUG:
             time_gf = time.time()
             time_gf_diff = time_gf - time_start
             print("Image size after grayscale: {}, Time to process: {}".format(img.shape, time_gf_diff))
         if self.transforms.rwave_data_only:
-            rwave_diff, rwave_indexes = self.calc_rwave_data(rwaves)
+            rwave_diff, rwave_start = self.calc_rwave_data(rwaves)
         if self.transforms.rescale_fps or self.transforms.resize_frames or self.transforms.rescale_fphb:
             assert not (self.transforms.rescale_fps and self.transforms.rescale_fphb)
             # Rescale length by either fps or fphb
@@ -153,25 +192,25 @@ class DataAugmentations:
 
             img = self.t_resize(img, new_length, new_height, new_width)
 
-        if self.debug:
+        if DEBUG:
             time_rescale = time.time()
             time_fps_diff = time_rescale - time_gf
             print("Image size after rescaling: {}, Time to process: {}".format(img.shape, time_fps_diff))
         assert not (self.transforms.loop_length and self.transforms.crop_length and self.transforms.rwave_data_only)
         if self.transforms.crop_sides or self.transforms.crop_length:
             img = self.t_crop(img)
-        if self.debug:
+        if DEBUG:
             time_crop = time.time()
             time_crop_diff = time_crop - time_rescale
             print("Image size after cropping: {}, Time to process: {}".format(img.shape, time_crop_diff))
         if self.transforms.rwave_data_only:
             new_fps = fps * (self.transforms.target_fphb / curr_fphb)
-            img = self.t_crop_rwave(img, rwaves, rwave_indexes, new_fps)
+            img = self.t_crop_rwave(img, rwave_start, new_fps)
         if self.transforms.loop_length:
             img = self.t_loop_length(img)
         if self.transforms.pad_length:
             img = self.t_pad_length(img)
-        if self.debug:
+        if DEBUG:
             time_loop = time.time()
             time_loop_diff = time_loop - time_crop
             print("Image size after length looping: {}, Time to process: {}".format(img.shape, time_loop_diff))
@@ -207,8 +246,9 @@ class DataAugmentations:
         :param img: The input image, shape assumed to be (L,H,W,C)
         :return: The transformed image in shape (L,H,W,1)
         '''
-        img = np.average(img, axis=-1)
-        return img.astype(np.uint8)
+        # Integer sum and floor division gives the same result as a truncated float mean
+        img = img.sum(axis=-1, dtype=np.uint16) // img.shape[-1]
+        return np.expand_dims(img.astype(np.uint8), axis=-1)
 
     def t_normalize(self, img):
         '''
@@ -224,31 +264,77 @@ class DataAugmentations:
         :param img: The input image to be transformed.
         :return: The image with values normalized to the new range in float format.
         '''
-        return ((img / 255.) * 2 - 1).astype(np.float32)
+        img = img.astype(np.float32)
+        img *= 2 / 255.
+        img -= 1
+        return img
 
     def t_gaussian_noise(self, img):
         '''
         Applies gaussian noise to an input image.
-        :param img: The input image to be transformed.
+        :param img: The input image to be transformed, float32. Modified in place.
         :return: The image with added noise
         '''
-        return random_noise(img, mode='gaussian', var=self.augmentations.gn_var)
+        noise, = self.get_noise(img.shape)
+        img += noise * (math.sqrt(self.augmentations.gn_var) * self.noise_scale)
+        return np.clip(img, self.black_val, self.white_val, out=img)
 
     def t_salt_and_pepper(self, img):
         '''
         Applies salt and pepper noise to an input image.
-        :param img: The input image to be transformed.
+        :param img: The input image to be transformed, float32. Modified in place.
         :return: The image with added noise
         '''
-        return random_noise(img, mode='s&p', amount=self.augmentations.salt_and_pepper_amount)
+        amount = self.augmentations.salt_and_pepper_amount
+        flipped = np.random.default_rng().random(img.shape, dtype=np.float32)
+        # Half of the flipped pixels become salt and the other half pepper
+        img[flipped < amount] = self.black_val
+        img[flipped < amount / 2] = self.white_val
+        return img
 
     def t_speckle(self, img):
         '''
         Applies speckle noise to an input image.
-        :param img: The input image to be transformed.
+        :param img: The input image to be transformed, float32. Modified in place.
         :return: The image with added noise
         '''
-        return random_noise(img, mode='speckle', var=self.augmentations.speckle_var)
+        noise, = self.get_noise(img.shape)
+        noise = noise * math.sqrt(self.augmentations.speckle_var)
+        noise += 1
+        img *= noise
+        return np.clip(img, self.black_val, self.white_val, out=img)
+
+    def t_gaussian_speckle(self, img):
+        '''
+        Applies gaussian noise followed by speckle noise to an input image in one pass, clipping only once at the end.
+        :param img: The input image to be transformed, float32. Modified in place.
+        :return: The image with added noise
+        '''
+        gaussian, speckle = self.get_noise(img.shape, 2)
+        noise = gaussian * (math.sqrt(self.augmentations.gn_var) * self.noise_scale)
+        img += noise
+        # Reuse the buffer for the speckle factor
+        np.multiply(speckle, math.sqrt(self.augmentations.speckle_var), out=noise)
+        noise += 1
+        img *= noise
+        return np.clip(img, self.black_val, self.white_val, out=img)
+
+    def get_noise(self, shape, n=1):
+        '''
+        Returns standard normal float32 noise from a small pool instead of drawing new noise for every sample.
+        :param shape: Shape of the noise, (L,H,W,C)
+        :param n: Number of independent noise arrays
+        :return: List of n read only noise arrays from different slots of the pool, each randomly reversed in time
+        '''
+        pid = os.getpid()
+        if self.noise_pool is None or self.noise_pool_pid != pid or self.noise_pool.shape[1:] != shape:
+            # Drawn per process with a generator seeded from the OS so forked DataLoader workers never share noise
+            self.noise_pool = np.random.default_rng().standard_normal((NOISE_POOL_SIZE,) + tuple(shape),
+                                                                      dtype=np.float32)
+            self.noise_pool.flags.writeable = False
+            self.noise_pool_pid = pid
+        noises = [self.noise_pool[i] for i in sample(range(NOISE_POOL_SIZE), n)]
+        return [noise[::-1] if randint(0, 1) else noise for noise in noises]
 
     def t_resize(self, img, target_length, target_height, target_width):
         '''
@@ -260,8 +346,48 @@ class DataAugmentations:
         :param target_width: The new width the input image will be resized into
         :return: The resized image with shape (target_length, target_height, target_width, C)
         '''
-        return resize(img, (target_length, target_height, target_width), mode='constant', cval=self.black_val,
-                      preserve_range=True, anti_aliasing=True).astype(np.uint8)
+        # Length is resized by picking the nearest frames, do it first when it reduces the frames left to resize
+        if target_length < img.shape[0]:
+            img = self.t_resample_length(img, target_length)
+        if not (img.shape[1] == target_height and img.shape[2] == target_width):
+            # cv2 has no int8 support (flow data)
+            if img.dtype != np.uint8:
+                img = img.astype(np.float32)
+            resized = np.empty((img.shape[0], target_height, target_width, img.shape[3]), dtype=img.dtype)
+            for i, frame in enumerate(img):
+                resized[i] = self.cv2_resize(frame, target_height, target_width, cv2.INTER_AREA)
+            img = resized
+        if target_length > img.shape[0]:
+            img = self.t_resample_length(img, target_length)
+        return img.astype(np.uint8)
+
+    def cv2_resize(self, frame, target_height, target_width, interpolation):
+        '''
+        Resizes a single frame with cv2.resize for any number of channels.
+        :param frame: The input frame, shape is assumed to be (H,W,C)
+        :param target_height: The new height of the frame
+        :param target_width: The new width of the frame
+        :param interpolation: cv2 interpolation flag
+        :return: The resized frame with shape (target_height, target_width, C)
+        '''
+        channels = frame.shape[2]
+        if channels > 4:
+            # Not all cv2 interpolations support more than 4 channels
+            return np.concatenate([self.cv2_resize(np.ascontiguousarray(frame[:, :, c:c + 4]), target_height,
+                                                   target_width, interpolation) for c in range(0, channels, 4)], axis=2)
+        # cv2 drops the channel axis for single channel frames
+        return cv2.resize(frame, (target_width, target_height),
+                          interpolation=interpolation).reshape(target_height, target_width, channels)
+
+    def t_resample_length(self, img, target_length):
+        '''
+        Resamples the length of the input image to the supplied length using the nearest frames.
+        :param img: The input image, shape is assumed to be (L,H,W,C)
+        :param target_length: The new length of the image
+        :return: The resampled image with shape (target_length, H, W, C)
+        '''
+        indexes = np.linspace(0, img.shape[0] - 1, target_length).round().astype(np.int64)
+        return img[indexes]
 
     def calc_fphb(self, hr, fps):
         '''
@@ -320,12 +446,10 @@ class DataAugmentations:
         :param img: The input image to be looped with the shape (L,H,W,C)
         :return: The transformed image with the shape (self.transforms.target_length, H, W, C).
         '''
-        org_img = img
-        while len(img) < self.transforms.target_length:
-            if len(org_img) <= self.transforms.target_length - len(img):
-                img = np.append(img, org_img, axis=0)
-            else:
-                img = np.append(img, org_img[0:self.transforms.target_length - len(img)], axis=0)
+        if len(img) < self.transforms.target_length:
+            # Ceil division, enough repetitions to cover the target length
+            n_loops = -(-self.transforms.target_length // len(img))
+            img = np.tile(img, (n_loops, 1, 1, 1))[0:self.transforms.target_length]
         return img.astype(np.uint8)
 
     def t_crop(self, img):
@@ -334,50 +458,27 @@ class DataAugmentations:
         :param img: Input image to be cropped with shape (L,H,W,C)
         :return: The cropped image with shape (self.transforms.target_length,H,W,C)
         '''
-        # Crop edges of frames
-        crop_sequence = [(0, 0), (0, 0), (0, 0), (0, 0)]
+        # Crop frames off the end, the frame edges are left as they are
         if self.transforms.crop_length and img.shape[0] > self.transforms.target_length:
-            diff = img.shape[0] - self.transforms.target_length
-            crop_sequence[0] = (0, diff)
-        return crop(img, crop_width=tuple(crop_sequence)).astype(np.uint8)
+            img = img[:self.transforms.target_length]
+        return img.astype(np.uint8)
 
-    def t_crop_rwave(self, video, rwaves, rwave_indexes, fps):
+    def t_crop_rwave(self, video, rwave_start, fps):
         '''
-        Crops the length of the input video the frames between the selected rwaves.
+        Crops the length of the input video to the frames of the heartbeat starting at the selected rwave.
         The length of the video is equal to the frames per heartbeat value that the video is normalized to.
         :param video: Input video to be cropped with shape (L,H,W,C)
-        :param rwaves: Array with timestamps for rwaves in milliseconds
-        :param rwave_indexes: The indexes of the selected rwaves
+        :param rwave_start: Time of the first rwave of the heartbeat in seconds, from calc_rwave_data
         :param fps: The fps of the input video
         :return: The cropped image with shape (fphb,H,W,C)
         '''
-        # Base case
-        if video.shape[0] == self.transforms.target_fphb:
-            return video
-        start_frame = int((rwaves[rwave_indexes[0]] / 1000) * fps)
-        end_frame = int((rwaves[rwave_indexes[1]] / 1000) * fps)
-        # Need to fix some croppings as int rounding makes some videos 1 frame too long or too short
-        if end_frame > video.shape[0]:
-            end_frame -= 1
-            start_frame -= 1
-        if (end_frame - start_frame) < self.transforms.target_fphb:
-            #print("Current length incorrect. Shape: {} Start: {} End: {}".format(video.shape, start_frame, end_frame))
-            if end_frame < video.shape[0]:
-                end_frame += 1
-            elif start_frame > 0:
-                start_frame -= 1
-            else:
-                raise ValueError("Cannot extend crop into correct shape")
-        elif (end_frame - start_frame) > self.transforms.target_fphb:
-            #print("Current length incorrect. Shape: {} Start: {} End: {}".format(video.shape, start_frame, end_frame))
-            if start_frame < (end_frame - 1):
-                start_frame += 1
-            elif end_frame > (start_frame + 1):
-                end_frame -= 1
-            else:
-                raise ValueError("Cannot extend crop into correct shape")
-        rwave_frames = video[start_frame:end_frame]
-        return rwave_frames
+        fphb = self.transforms.target_fphb
+        # Int rounding can put the end 1 frame past the video, shift the crop back inside it instead
+        end_frame = min(int(rwave_start * fps) + fphb, video.shape[0])
+        start_frame = end_frame - fphb
+        if start_frame < 0:
+            raise ValueError("Cannot extend crop into correct shape")
+        return video[start_frame:end_frame]
 
     def t_translate_v(self, video):
         '''
@@ -386,24 +487,16 @@ class DataAugmentations:
         :return: The image sequence with the same shape (L,H,W,C) but each frame has been translated.
         '''
         t_len = int(np.random.normal(0, self.augmentations.translate_v_std_dev_pxl))
+        if t_len == 0:
+            return video
 
-        video = video.transpose(3, 0, 1, 2)
-
+        # The shift is the same for all frames and channels so it is done as one slice copy
         final_video = np.full_like(video, self.black_val)
-        for i, channel in enumerate(video):
-            new_img = np.full_like(channel, self.black_val)
-            for j, frame in enumerate(channel):
-                translated_frame = np.full_like(frame, self.black_val)
-                if t_len < 0:
-                    translated_frame[0:t_len, :] = frame[-t_len:, :]
-                elif t_len > 0:
-                    translated_frame[t_len:, :] = frame[0:-t_len, :]
-                else:
-                    translated_frame = frame
-                new_img[j] = translated_frame
-            final_video[i] = new_img
-
-        return final_video.transpose(1, 2, 3, 0)
+        if t_len < 0:
+            final_video[:, 0:t_len] = video[:, -t_len:]
+        else:
+            final_video[:, t_len:] = video[:, 0:-t_len]
+        return final_video
 
     def t_translate_h(self, video):
         '''
@@ -412,23 +505,16 @@ class DataAugmentations:
         :return: The image sequence with the same shape (L,H,W,C) but each frame has been translated.
         '''
         t_len = int(np.random.normal(0, self.augmentations.translate_h_std_dev_pxl))
+        if t_len == 0:
+            return video
 
-        video = video.transpose(3, 0, 1, 2)
-
+        # The shift is the same for all frames and channels so it is done as one slice copy
         final_video = np.full_like(video, self.black_val)
-        for i, channel in enumerate(video):
-            new_img = np.full_like(channel, self.black_val)
-            for j, frame in enumerate(channel):
-                translated_frame = np.full_like(frame, self.black_val)
-                if t_len < 0:
-                    translated_frame[:, 0:t_len] = frame[:, -t_len:]
-                elif t_len > 0:
-                    translated_frame[:, t_len:] = frame[:, 0:-t_len]
-                else:
-                    translated_frame = frame
-                new_img[j] = translated_frame
-            final_video[i] = new_img
-        return final_video.transpose(1, 2, 3, 0)
+        if t_len < 0:
+            final_video[:, :, 0:t_len] = video[:, :, -t_len:]
+        else:
+            final_video[:, :, t_len:] = video[:, :, 0:-t_len]
+        return final_video
 
     def t_rotate(self, video):
         '''
@@ -438,16 +524,21 @@ class DataAugmentations:
         '''
         t_rotation = np.random.normal(0, self.augmentations.rotate_std_dev_degrees)
 
-        video = video.transpose(3, 0, 1, 2)
-
-        final_video = np.full_like(video, self.black_val)
-        for i, channel in enumerate(video):
-            new_img = np.full_like(channel, self.black_val)
-            for j, frame in enumerate(channel):
-                rotated_frame = rotate(frame, t_rotation, resize=False, mode='constant', cval=self.black_val, preserve_range=True)
-                new_img[j] = rotated_frame
-            final_video[i] = new_img
-        return final_video.transpose(1, 2, 3, 0)
+        height, width = video.shape[1], video.shape[2]
+        # Same center and counter-clockwise direction as skimage.transform.rotate
+        rot_matrix = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), t_rotation, 1.0)
+        # A scalar border value would only be used for the first channel
+        border_val = (self.black_val,) * 4
+
+        final_video = np.empty_like(video)
+        for i, frame in enumerate(video):
+            # cv2 warps at most 4 channels at once
+            for c in range(0, video.shape[3], 4):
+                rotated_frame = cv2.warpAffine(np.ascontiguousarray(frame[:, :, c:c + 4]), rot_matrix, (width, height),
+                                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                                               borderValue=border_val)
+                final_video[i, :, :, c:c + 4] = rotated_frame.reshape(height, width, -1)
+        return final_video
 
     def t_local_blackout(self, video):
         '''
@@ -463,13 +554,9 @@ class DataAugmentations:
         bo_pos_h = np.random.randint(0, video.shape[1] - bo_size_h)
         bo_pos_w = np.random.randint(0, video.shape[2] - bo_size_w)
 
-        video = video.transpose(3, 0, 1, 2)
-
-        for i, channel in enumerate(video):
-            for j, frame in enumerate(channel):
-                frame[bo_pos_h:bo_pos_h+bo_size_h, bo_pos_w:bo_pos_w+bo_size_w] = self.black_val
-
-        return video.transpose(1, 2, 3, 0)
+        # Same box in every frame and channel
+        video[:, bo_pos_h:bo_pos_h+bo_size_h, bo_pos_w:bo_pos_w+bo_size_w, :] = self.black_val
+        return video
 
     def t_local_intensity(self, video):
         '''
@@ -486,25 +573,25 @@ class DataAugmentations:
 
         ints_val = np.random.normal(0, self.augmentations.intensity_var)
 
-        video = video.transpose(3, 0, 1, 2)
-
-        for i, channel in enumerate(video):
-            for j, frame in enumerate(channel):
-                frame[ints_pos_h:ints_pos_h+ints_size_h, ints_pos_w:ints_pos_w+ints_size_w] = \
-                    frame[ints_pos_h:ints_pos_h+ints_size_h, ints_pos_w:ints_pos_w+ints_size_w] + ints_val
-        video = np.clip(video, self.black_val, self.white_val)
-        return video.transpose(1, 2, 3, 0)
+        # Same box in every frame and channel, only the box can go out of range so only it is clipped
+        box = video[:, ints_pos_h:ints_pos_h+ints_size_h, ints_pos_w:ints_pos_w+ints_size_w, :]
+        box += ints_val
+        np.clip(box, self.black_val, self.white_val, out=box)
+        return video
 
     def calc_rwave_data(self, rwaves):
-        max_diff = 0
-        max_diff_indexes = (0, 0)
-        for i, _ in enumerate(rwaves):
-            if i != 0:
-                diff = (rwaves[i] - rwaves[i - 1]) / 1000
-                if diff > max_diff:
-                    max_diff = diff
-                    max_diff_indexes = (i - 1, i)
-        return max_diff, max_diff_indexes
+        '''
+        Finds the longest interval between two consecutive r-waves, the heartbeat used for rwave cropping.
+        :param rwaves: R-wave times in ms
+        :return: The longest interval and the time of its first r-wave, both in seconds.
+        If there is no interval, 0 and the time of the first r-wave.
+        '''
+        rwaves = np.asarray(rwaves, dtype=np.float64) / 1000
+        diffs = np.diff(rwaves)
+        i = int(np.argmax(diffs)) if diffs.size else 0
+        if diffs.size == 0 or diffs[i] <= 0:
+            return 0, (float(rwaves[0]) if rwaves.size else 0.0)
+        return float(diffs[i]), float(rwaves[i])
 
     def t_zoom(self, img):
         zoom_factor = 1 + np.random.normal(0, self.augmentations.zoom_factor_std_dev)
@@ -512,35 +599,30 @@ class DataAugmentations:
         # In those cases we dont zoom.
         if zoom_factor < 0:
             zoom_factor = 1
-        new_img = np.zeros_like(img)
-        new_img = new_img + self.black_val
-        diff_height = None
-        diff_width = None
+        height, width = img.shape[1], img.shape[2]
+        # Same output size as skimage.transform.rescale
+        zoom_height = max(int(round(height * zoom_factor)), 1)
+        zoom_width = max(int(round(width * zoom_factor)), 1)
+        # Base case
+        if zoom_height == height and zoom_width == width:
+            return img
+        # Calculate offsets for zoomed frames, the same for every frame
+        if zoom_factor > 1:
+            new_img = np.empty_like(img)
+            diff_h_start = int((zoom_height - height) / 2)
+            diff_w_start = int((zoom_width - width) / 2)
+            interpolation = cv2.INTER_LINEAR
+        else:
+            new_img = np.full_like(img, self.black_val)
+            diff_h_start = int((height - zoom_height) / 2)
+            diff_w_start = int((width - zoom_width) / 2)
+            interpolation = cv2.INTER_AREA
         for i, frame in enumerate(img):
-            zoom_frame = rescale(frame, zoom_factor, mode='constant', cval=self.black_val, preserve_range=True,
-                                 multichannel=True)
-            # Calculate offsets for zoomed frame
-            if diff_height is None or diff_width is None:
-                diff_height = zoom_frame.shape[0] - img.shape[1]
-                diff_width = zoom_frame.shape[1] - img.shape[2]
-                # Base case
-                if zoom_factor == 1 or (diff_height == 0 and diff_width == 0):
-                    return img
-                elif zoom_factor > 1:
-                    diff_h_start = int(diff_height / 2)
-                    diff_h_end = img.shape[1] + diff_h_start
-                    diff_w_start = int(diff_width / 2)
-                    diff_w_end = img.shape[2] + diff_w_start
-                elif zoom_factor < 1:
-                    diff_h_start = int(abs(diff_height) / 2)
-                    diff_h_end = zoom_frame.shape[0] + diff_h_start
-                    diff_w_start = int(abs(diff_width) / 2)
-                    diff_w_end = zoom_frame.shape[1] + diff_w_start
-
+            zoom_frame = self.cv2_resize(frame, zoom_height, zoom_width, interpolation)
             # Set new frame to zoomed frame
             if zoom_factor > 1:
-                new_img[i] = zoom_frame[diff_h_start:diff_h_end, diff_w_start:diff_w_end, :]
-            elif zoom_factor < 1:
-                new_img[i, abs(diff_h_start):abs(diff_h_end), abs(diff_w_start):abs(diff_w_end), :] = zoom_frame
+                new_img[i] = zoom_frame[diff_h_start:diff_h_start + height, diff_w_start:diff_w_start + width, :]
+            else:
+                new_img[i, diff_h_start:diff_h_start + zoom_height, diff_w_start:diff_w_start + zoom_width, :] = zoom_frame
         return new_img
 
@@ -18,6 +18,7 @@ class MultiStreamDataset(torch.utils.data.Dataset):
         self.allowed_views = cfg_data.allowed_views
         self.data_in_mem = cfg_data.data_in_mem
         self.preprocessed_data_on_disk = cfg_data.preprocessed_data_on_disk
+        self.n_load_procs = cfg_data.get('n_load_procs', None) or mp.cpu_count() - 2
         self.targets = pd.read_csv(os.path.abspath(target_file), sep=cfg_data.file_sep)
         self.rwave_only = cfg_transforms.rwave_data_only
         if self.rwave_only:
@@ -167,9 +168,9 @@ class MultiStreamDataset(torch.utils.data.Dataset):
         return data_list, np.expand_dims(target, axis=0).astype(np.float32), index, exam, iid_list
 
     def load_data_into_mem(self):
-        nprocs = mp.cpu_count()
-        print(f"Number of CPU cores: {nprocs}")
-        pool = mp.Pool(processes=nprocs-2)
+        nprocs = self.n_load_procs
+        print(f"Number of loading processes: {nprocs}")
+        pool = mp.Pool(processes=nprocs)
         iterator = self.targets.itertuples(index=False, name=None)
         result = pool.map(self.read_image_data, iterator)
         pool.close()
@@ -181,9 +182,9 @@ class MultiStreamDataset(torch.utils.data.Dataset):
         print('All data loaded into memory')
 
     def load_data_to_disk(self):
-        nprocs = mp.cpu_count()
-        print(f"Number of CPU cores: {nprocs}")
-        pool = mp.Pool(processes=nprocs-2)
+        nprocs = self.n_load_procs
+        print(f"Number of loading processes: {nprocs}")
+        pool = mp.Pool(processes=nprocs)
         iterator = self.targets.itertuples(index=False, name=None)
         pool.map(self.write_data_to_disk, iterator)
         pool.close()
@@ -220,11 +221,12 @@ class MultiStreamDataset(torch.utils.data.Dataset):
             if target is None:
                 raise ValueError("Target is None")
             # Process img
-            img = np.load(fp_img, allow_pickle=True)
+            # Memory mapped so only the frames used by transform_size are read from disk
+            img = np.load(fp_img, mmap_mode='r', allow_pickle=False)
             if img is None:
                 raise ValueError("Img is None")
             # Process flow
-            flow = np.load(fp_flow, allow_pickle=True)
+            flow = np.load(fp_flow, mmap_mode='r', allow_pickle=False)
             if flow is None:
                 raise ValueError("Flow is None")
             if not self.preprocessed_data_on_disk:
@@ -4,12 +4,19 @@ import numpy as np
 from data import data_augmentations
 import random
 import os
+import hashlib
 import multiprocessing as mp
 
+# Transform settings that change the output of transform_size, the cache folder is keyed on them
+SIZE_TRANSFORM_KEYS = ['grayscale', 'rescale_fps', 'target_fps', 'rescale_fphb', 'target_fphb', 'resize_frames',
+                       'target_height', 'target_width', 'crop_sides', 'crop_length', 'loop_length', 'pad_length',
+                       'target_length', 'rwave_data_only']
+
 
 class NPYDataset(torch.utils.data.Dataset):
     def __init__(self, cfg_data, cfg_transforms, cfg_augmentations, target_file, is_eval_set):
         super(NPYDataset).__init__()
+        assert not (cfg_data.data_in_mem and cfg_data.cache_transformed)
 
         self.is_eval_set = is_eval_set
         self.targets = pd.read_csv(os.path.abspath(target_file), sep=cfg_data.file_sep)
@@ -17,12 +24,27 @@ class NPYDataset(torch.utils.data.Dataset):
             self.targets['target'] = self.targets['target'].apply(lambda x: x / 100)
         self.targets = self.targets[self.targets['view'].isin(cfg_data.allowed_views)].reset_index(drop=True)
         self.unique_exams = self.targets.drop_duplicates('us_id')['us_id'].copy()
-        self.data_aug = data_augmentations.DataAugmentations(cfg_transforms, cfg_augmentations)
+        # Plain python/numpy lookups for __getitem__ instead of filtering and indexing the DataFrame per sample
+        self.exam_ids = self.unique_exams.to_numpy()
+        self.exam_indexes = self.targets.groupby('us_id').indices
+        self.target_rows = list(self.targets.itertuples(index=False, name=None))
+        self.data_aug = data_augmentations.DataAugmentations(cfg_transforms, cfg_augmentations,
+                                                             return_uint8=cfg_transforms.normalize_on_gpu)
         self.data_type = cfg_data.type
         self.base_folder = cfg_data.data_folder
         self.data_in_mem = cfg_data.data_in_mem
+        self.n_load_procs = cfg_data.get('n_load_procs', None) or mp.cpu_count()
+        self.transforms = cfg_transforms
+        self.use_cache = False
         if self.data_in_mem:
             self.load_data_into_mem()
+        if cfg_data.cache_transformed:
+            # The deterministic transform_size runs once per file here, in training only transform_values runs
+            self.cache_folder = os.path.join(cfg_data.cache_dir, self.cache_key(cfg_transforms))
+            print("Caching transformed data in {}".format(self.cache_folder))
+            self.load_data_to_disk()
+            self.base_folder = self.cache_folder
+            self.use_cache = True
 
     def __len__(self):
         if self.is_eval_set:
@@ -30,38 +52,65 @@ class NPYDataset(torch.utils.data.Dataset):
         else:
             return len(self.unique_exams)
 
-    def __getitem__(self, data_index):
+    def __getitem__(self, index):
+        if self.is_eval_set:
+            data_index = index
+        else:
+            # Random instance of the exam
+            data_index = random.choice(self.exam_indexes[self.exam_ids[index]])
         if self.data_in_mem:
-            if not self.is_eval_set:
-                exam = self.unique_exams.iloc[data_index]
-                all_exam_indx = self.data_frame[self.data_frame['us_id'] == exam].index
-                data_index = random.choice(all_exam_indx)
-            img = self.data_frame.iloc[data_index].img
-            target = self.data_frame.iloc[data_index].target
-            uid = self.data_frame.iloc[data_index].us_id
+            img, target, uid = self.data_list[data_index]
         else:
-            if not self.is_eval_set:
-                exam = self.unique_exams.iloc[data_index]
-                all_exam_indx = self.targets[self.targets['us_id'] == exam].index
-                data_index = random.choice(all_exam_indx)
-            img, target, uid = self.read_image_data(tuple(self.targets.iloc[data_index]))
+            img, target, uid = self.read_image_data(self.target_rows[data_index])
         img = self.data_aug.transform_values(img)
         return img.transpose(3, 0, 1, 2), np.expand_dims(target, axis=0).astype(np.float32), index, uid
 
     def load_data_into_mem(self):
-        nprocs = mp.cpu_count()
-        print(f"Number of CPU cores: {nprocs}")
+        nprocs = self.n_load_procs
+        print(f"Number of loading processes: {nprocs}")
         pool = mp.Pool(processes=nprocs)
         iterator = self.targets.itertuples(index=False, name=None)
-        result = pool.map(self.read_image_data, iterator)
+        # (img, target, uid) for every row in self.targets, in the same order
+        self.data_list = pool.map(self.read_image_data, iterator)
         pool.close()
         pool.join()
-        data_list = []
-        for r in result:
-            data_list.append(r)
-        self.data_frame = pd.DataFrame(data_list, columns = ['img', 'target', 'us_id'])
         print('All data loaded into memory')
 
+    @staticmethod
+    def cache_key(cfg_transforms):
+        '''
+        Name of the cache folder for a transform config, so data transformed with other settings is never reused.
+        :param cfg_transforms: OmegaConf object for transform settings
+        :return: Output size followed by a hash of all settings that change transform_size
+        '''
+        settings = ','.join('{}={}'.format(k, cfg_transforms.get(k, None)) for k in SIZE_TRANSFORM_KEYS)
+        return '{}x{}x{}_{}'.format(cfg_transforms.target_length, cfg_transforms.target_height,
+                                    cfg_transforms.target_width, hashlib.md5(settings.encode()).hexdigest()[:10])
+
+    def load_data_to_disk(self):
+        nprocs = self.n_load_procs
+        print(f"Number of loading processes: {nprocs}")
+        pool = mp.Pool(processes=nprocs)
+        iterator = self.targets.itertuples(index=False, name=None)
+        pool.map(self.write_data_to_disk, iterator)
+        pool.close()
+        pool.join()
+        print('All data processed and loaded to disk')
+
+    def write_data_to_disk(self, data):
+        uid, _, _, _, _, file_img, file_flow, _ = data
+        file = file_flow if self.data_type == 'flow' else file_img
+        folder = os.path.join(self.cache_folder, uid)
+        fp = os.path.join(folder, file)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        if os.path.exists(fp) and not os.path.getsize(fp) == 0:
+            return 0
+        result = self.read_image_data(data)
+        if result is not None:
+            np.save(fp, result[0])
+        return 0
+
     def read_image_data(self, data):
         uid, _, _, fps, hr, file_img, file_flow, target = data
         if self.data_type == 'flow':
@@ -70,8 +119,17 @@ class NPYDataset(torch.utils.data.Dataset):
             file = file_img
         fp = os.path.join(os.path.join(self.base_folder, uid), file)
         try:
-            img = np.load(fp, allow_pickle=True)
-            img = self.data_aug.transform_size(img, fps, hr)
+            if self.use_cache:
+                # Already transformed, every frame is used
+                img = np.load(fp, allow_pickle=False)
+                if img.shape[:3] != (self.transforms.target_length, self.transforms.target_height,
+                                     self.transforms.target_width):
+                    raise ValueError("Cached video has shape {}, delete {} to rebuild the cache".format(
+                        img.shape, self.cache_folder))
+            else:
+                # Memory mapped so only the frames used by transform_size are read from disk
+                img = np.load(fp, mmap_mode='r', allow_pickle=False)
+                img = self.data_aug.transform_size(img, fps, hr, None)
             if target is None:
                 raise ValueError("Target is None")
             if img is None:
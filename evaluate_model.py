@@ -4,7 +4,7 @@ from torch.utils.data import DataLoader
 from torch.cuda.amp import autocast
 from sklearn.metrics import r2_score
 import hydra
-from utils.utils import AverageMeter
+from utils.utils import AverageMeter, autocast_kwargs
 import os
 from models import i3d_bert, multi_stream
 from omegaconf import DictConfig
@@ -77,7 +77,7 @@ def main(cfg: DictConfig) -> None:
 
         with torch.no_grad():
             # Get model validation output and validation loss
-            with autocast(enabled=use_half_prec):
+            with autocast(enabled=use_half_prec, **autocast_kwargs(cfg)):
                 outputs_t = model(inputs_t)
                 loss_t = criterion(outputs_t, targets_t)
 
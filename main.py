@@ -2,10 +2,11 @@ import torch
 from torch.utils.data import DataLoader, WeightedRandomSampler, RandomSampler
 from models import custom_cnn, resnext, i3d_bert, multi_stream
 from training import train_and_validate
-import neptune.new as neptune
+from utils.utils import use_pin_memory, use_persistent_workers, prefetch_kwargs, check_prefetch_memory
 import hydra
 from data.npy_dataset import NPYDataset
 from data.multi_stream_dataset import MultiStreamDataset, MultiStreamDatasetNoFlow
+from data.data_augmentations import init_worker
 from omegaconf import DictConfig
 from collections import OrderedDict
 import logging
@@ -198,6 +199,8 @@ def main(cfg: DictConfig) -> None:
 
     experiment = None
     if cfg.logging.logging_enabled:
+        # Imported here so runs without logging skip the neptune import
+        import neptune.new as neptune
         experiment_params = {**dict(cfg.data_loader), **dict(cfg.transforms), **dict(cfg.augmentations),
                              **dict(cfg.performance), **dict(cfg.training), **dict(cfg.optimizer), **dict(cfg.model),
                              **dict(cfg.evaluation), 'target_file': cfg.data.train_targets, 'data_stream': cfg.data.type, 'view': cfg.data.name,
@@ -221,10 +224,16 @@ def create_data_loaders(cfg, train_d_set, val_d_set):
         sampler = RandomSampler(train_d_set)
     train_data_loader = DataLoader(train_d_set, batch_size=cfg.data_loader.batch_size_train,
                                    num_workers=cfg.data_loader.n_workers, drop_last=cfg.data_loader.drop_last,
-                                   sampler=sampler, pin_memory=True)
+                                   sampler=sampler, pin_memory=use_pin_memory(cfg),
+                                   persistent_workers=use_persistent_workers(cfg), worker_init_fn=init_worker,
+                                   **prefetch_kwargs(cfg))
 
     val_data_loader = DataLoader(val_d_set, batch_size=cfg.data_loader.batch_size_eval,
-                                 num_workers=cfg.data_loader.n_workers, drop_last=cfg.data_loader.drop_last, pin_memory=True)
+                                 num_workers=cfg.data_loader.n_workers, drop_last=cfg.data_loader.drop_last,
+                                 pin_memory=use_pin_memory(cfg), persistent_workers=use_persistent_workers(cfg),
+                                 worker_init_fn=init_worker, **prefetch_kwargs(cfg))
+
+    check_prefetch_memory(cfg, train_d_set, val_d_set)
 
     return train_data_loader, val_data_loader
 
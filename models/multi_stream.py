@@ -5,6 +5,21 @@ import torch
 import torch.nn.functional as F
 
 
+def shared_forward(model, inputs):
+    '''
+    Runs all inputs of a shared weights stream through the model as one concatenated batch in eval mode.
+    In training mode, or if the input shapes differ, the model is called once per input, so BatchNorm keeps
+    computing its batch statistics and updating its running stats per input.
+    :param model: Stream model shared by the inputs
+    :param inputs: List of input tensors
+    :return: List of output tensors, one per input
+    '''
+    inputs = list(inputs)
+    if not model.training and all(inp.shape == inputs[0].shape for inp in inputs[1:]):
+        return list(model(torch.cat(inputs, dim=0)).chunk(len(inputs), dim=0))
+    return [model(inp) for inp in inputs]
+
+
 class MultiStream(nn.Module):
     '''
     Multi-Stream model.
@@ -30,12 +45,10 @@ class MultiStream(nn.Module):
     def forward(self, x):
         assert len(x) == self.num_models
 
-        y = []
-
-        for inp, model_name in zip(x, self.endpoint_keys):
-            y.append(self._modules[model_name](inp))
-        y = torch.stack(y, dim=1).squeeze().view(-1, self.fc_input_size)
-        y = self._modules[self.fc_name](F.relu(y))
+        modules = self._modules
+        # Each stream gives (batch, n_classes), concatenating them is the (batch, fc_input_size) fc input
+        y = torch.cat([modules[model_name](inp) for inp, model_name in zip(x, self.endpoint_keys)], dim=1)
+        y = modules[self.fc_name](F.relu(y))
         return y
 
 
@@ -64,14 +77,11 @@ class MultiStreamShared(nn.Module):
     def forward(self, x):
         assert len(x) == self.num_models
 
-        y = []
-
-        for i, inp in enumerate(x):
-            if i % 2 == 0:
-                y.append(self._modules[self.model_img_name](inp))
-            else:
-                y.append(self._modules[self.model_flow_name](inp))
-        y = torch.stack(y, dim=1).squeeze().view(-1, self.fc_input_size)
+        # Inputs alternate img, flow, img, flow...
+        y = [None] * len(x)
+        y[0::2] = shared_forward(self._modules[self.model_img_name], x[0::2])
+        y[1::2] = shared_forward(self._modules[self.model_flow_name], x[1::2])
+        y = torch.cat(y, dim=1)
         y = self._modules[self.fc_name](F.relu(y))
         return y
 
@@ -107,11 +117,7 @@ class MSNoFlowShared(nn.Module):
     def forward(self, x):
         assert len(x) == self.num_models
 
-        y = []
-
-        for i, inp in enumerate(x):
-            y.append(self._modules[self.model_img_name](inp))
-        y = torch.stack(y, dim=1).squeeze().view(-1, self.fc_input_size)
+        y = torch.cat(shared_forward(self._modules[self.model_img_name], x), dim=1)
         y = self._modules[self.fc_name](F.relu(y))
         return y
 
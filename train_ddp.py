@@ -1,4 +1,3 @@
-import neptune.new as neptune
 import hydra
 import torch
 import torch.multiprocessing as mp
@@ -8,8 +7,8 @@ import logging
 from copy import copy
 from omegaconf import DictConfig
 import os
-from utils.utils import create_and_load_model, create_data_sets, create_data_loaders, update_cfg, create_train_loader, log_train_metrics, log_val_metrics, save_checkpoint
-from utils.ddp_utils import prepare_ddp, init_distributed_mode, is_master, cleanup, is_dist_avail_and_initialized
+from utils.utils import create_and_load_model, create_data_sets, create_data_loaders, update_cfg, create_train_loader, log_train_metrics, log_val_metrics, save_checkpoint, AsyncCheckpointer, check_prefetch_memory
+from utils.ddp_utils import prepare_ddp, init_distributed_mode, is_master, cleanup, is_dist_avail_and_initialized, is_torchrun, create_setup_group
 from Trainers import DDPTrainer
 from Validators import DDPValidator
 
@@ -23,43 +22,87 @@ def main(cfg: DictConfig) -> None:
     assert cfg.model.name in ['ccnn', 'resnext', 'i3d', 'i3d_bert', 'i3d_bert_2stream']
     assert cfg.data.type in ['img', 'flow', 'multi-stream']
 
-    train_data_set, val_data_set = create_data_sets(cfg)
+    if is_torchrun():
+        # torchrun / torch.distributed.launch --use_env already started one process per gpu
+        prepare_ddp(cfg)
+        update_cfg(cfg, key='rank', val=int(os.environ['RANK']))
+        update_cfg(cfg, key='local_rank', val=int(os.environ['LOCAL_RANK']))
+        train_and_val(cfg)
+        return
 
     prepare_ddp(cfg)
-    mp.set_start_method('spawn')
+    # Only the rank processes need spawn (CUDA). Setting it globally would also make every DataLoader
+    # worker spawn and re-import this module and all its dependencies instead of forking.
+    ctx = mp.get_context('spawn')
     processes = []
     for rank in range(cfg.world_size):
         process_config = copy(cfg)
         update_cfg(process_config, key='rank', val=rank)
-        p = mp.Process(target=train_and_val, args=(process_config, train_data_set, val_data_set))
+        update_cfg(process_config, key='local_rank', val=rank)
+        p = ctx.Process(target=train_and_val, args=(process_config,))
         p.start()
         processes.append(p)
     for p in processes:
         p.join()
 
 
-def train_and_val(cfg, train_data_set, val_data_set):
+def train_and_val(cfg):
     ### INITIALIZE DDP ###
     if cfg.performance.ddp:
         init_distributed_mode(cfg)
 
+    ### SETUP DATA SETS ###
+    # Every rank builds its own instead of getting them pickled from the parent process.
+    if cfg.data.type == 'multi-stream':
+        writes_to_disk = cfg.data.preprocessed_data_on_disk
+    else:
+        writes_to_disk = cfg.data.cache_transformed
+    if is_dist_avail_and_initialized() and (writes_to_disk or cfg.data.data_in_mem):
+        # The master goes first, so the files it writes to disk are complete when the others check them and the
+        # files it reads into memory are in the page cache. The others then split the cpus between their pools.
+        setup_group = create_setup_group(cfg)
+        if not is_master():
+            # The master's node has one follower less
+            n_followers = max(1, cfg.local_world_size - (1 if cfg.rank == cfg.local_rank else 0))
+            update_cfg(cfg.data, key='n_load_procs', val=max(1, os.cpu_count() // n_followers))
+        if is_master():
+            train_data_set, val_data_set = create_data_sets(cfg)
+        dist.barrier(group=setup_group)
+        if not is_master():
+            train_data_set, val_data_set = create_data_sets(cfg)
+    else:
+        train_data_set, val_data_set = create_data_sets(cfg)
+
     ### SETUP MODEL ###
     # If distributed, the specific cuda device is configured in init_distributed_mode
     device = torch.device(cfg.performance.device)
     model, tags = create_and_load_model(cfg)
     model.to(device)
+    # NDHWC layout lets cuDNN use tensor cores for the 3D convolutions, mainly useful together with half precision
+    if cfg.performance.channels_last:
+        model.to(memory_format=torch.channels_last_3d)
     model_no_ddp = model
     if cfg.performance.ddp:
-        model = DDP(model, device_ids=[cfg.rank], find_unused_parameters=False)
+        ddp_kwargs = {}
+        if cfg.performance.ddp_static_graph:
+            ddp_kwargs['static_graph'] = True
+        # Gradients are views into the allreduce buckets instead of being copied into them after backward
+        model = DDP(model, device_ids=[cfg.local_rank], find_unused_parameters=False, gradient_as_bucket_view=True,
+                    bucket_cap_mb=cfg.performance.ddp_bucket_cap_mb, **ddp_kwargs)
+        if cfg.performance.ddp_grad_compression is not None:
+            register_compression_hook(model, cfg.performance.ddp_grad_compression)
         model_no_ddp = model.module
 
     # CUDNN Auto-tuner. Use True when input size and model is static
     torch.backends.cudnn.benchmark = cfg.performance.cuddn_auto_tuner
 
     ### SETUP LOGGING AND CHECKPOINTING ###
+    checkpointer = None
     if is_master():
         experiment = None
         if cfg.logging.logging_enabled:
+            # Imported here so runs without logging (and every re-import of this module) skip the neptune import
+            import neptune.new as neptune
             experiment_params = {**dict(cfg.data_loader), **dict(cfg.transforms), **dict(cfg.augmentations),
                                  **dict(cfg.performance), **dict(cfg.training), **dict(cfg.optimizer),
                                  **dict(cfg.model),
@@ -69,22 +112,33 @@ def train_and_val(cfg, train_data_set, val_data_set):
                                  'val_dataset_size': len(val_data_set)}
             experiment = neptune.init(project=cfg.logging.project_name, name=cfg.logging.experiment_name, tags=tags)
             experiment['parameters'] = experiment_params
+            # Fixed for the experiment, fetched from neptune once
+            experiment_id = experiment["sys/id"].fetch()
 
         if not os.path.exists(cfg.training.checkpoint_save_path):
             os.makedirs(cfg.training.checkpoint_save_path)
+        if cfg.training.checkpointing_enabled and cfg.training.checkpoint_async:
+            checkpointer = AsyncCheckpointer()
 
     ### SETUP CRITERION AND OPTIMIZER
     # Set loss criterion
     criterion = torch.nn.MSELoss(reduction='none')
-    # Set optimizer
-    optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model_no_ddp.parameters()),
-                                  lr=cfg.optimizer.learning_rate, weight_decay=cfg.optimizer.weight_decay)
+    # Set optimizer, only with the parameters that are trained
+    trainable_params = [p for p in model_no_ddp.parameters() if p.requires_grad]
+    optimizer_kwargs = {}
+    if cfg.optimizer.multi_tensor is not None:
+        assert cfg.optimizer.multi_tensor in ['foreach', 'fused']
+        optimizer_kwargs[cfg.optimizer.multi_tensor] = True
+    optimizer = torch.optim.AdamW(trainable_params, lr=cfg.optimizer.learning_rate,
+                                  weight_decay=cfg.optimizer.weight_decay, **optimizer_kwargs)
     if cfg.optimizer.use_scheduler:
         scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=cfg.optimizer.s_patience, factor=cfg.optimizer.s_factor)
 
     ### SETUP DATALOADERS ###
     if is_master():
         train_data_loader, val_data_loader = create_data_loaders(cfg, train_data_set, val_data_set)
+        # Every rank on this node has a train loader, only the master a val loader
+        check_prefetch_memory(cfg, train_data_set, val_data_set, n_train_loaders=cfg.local_world_size)
     else:
         train_data_loader = create_train_loader(cfg, train_data_set)
 
@@ -93,9 +147,19 @@ def train_and_val(cfg, train_data_set, val_data_set):
     trainer = DDPTrainer(criterion, device, cfg)
 
     max_val_r2 = None
+    n_validations = 0
+    # Checkpoint file name, with logging the experiment id is filled in when saving
+    checkpoint_template = '{}{}_{}_{}'.format(cfg.training.checkpoint_save_path, cfg.model.name, cfg.data.type,
+                                              cfg.data.name)
+    if cfg.logging.logging_enabled:
+        checkpoint_template += '_exp_{exp_id}.pth'
+    else:
+        checkpoint_template += '_test.pth'
 
     ### TRAINING START ###
     for i in range(cfg.training.epochs):
+        validation_epoch = i % 10 == 0
+
         # TRAIN EPOCH
         train_loss, train_r2 = trainer.train_epoch(model, train_data_loader, optimizer, i)
 
@@ -105,37 +169,60 @@ def train_and_val(cfg, train_data_set, val_data_set):
                 log_train_metrics(experiment, train_loss.avg[0], train_r2.avg[0], optimizer.param_groups[0]['lr'])
 
         # RUN VALIDATION
-        if is_master() and i % 10 == 0:
+        if is_master() and validation_epoch:
             val_loss_mean, val_r2 = validator.validate(model, val_data_loader, i)
 
 
             # VAL LOGGING/CHECKPOINTING
             if cfg.logging.logging_enabled:
-                experiment_id = experiment["sys/id"].fetch()
-                checkpoint_name = cfg.training.checkpoint_save_path + cfg.model.name + '_' + cfg.data.type + '_' \
-                                  + cfg.data.name + '_exp_' + experiment_id + '.pth'
+                checkpoint_name = checkpoint_template.format(exp_id=experiment_id)
                 log_val_metrics(experiment, val_loss_mean, val_r2, max_val_r2)
             else:
-                checkpoint_name = cfg.training.checkpoint_save_path + cfg.model.name + '_' + cfg.data.type + '_' \
-                                  + cfg.data.name + '_test' + '.pth'
-            if max_val_r2 is None or val_r2 > max_val_r2:
+                checkpoint_name = checkpoint_template
+            # New bests are only taken on every n-th validation, where they are also saved, so the checkpoint
+            # on disk is always the best one logged
+            checkpoint_validation = n_validations % cfg.training.checkpoint_every_n_validations == 0
+            n_validations += 1
+            if checkpoint_validation and (max_val_r2 is None or val_r2 > max_val_r2):
                 max_val_r2 = val_r2
                 if cfg.training.checkpointing_enabled:
-                    save_checkpoint(checkpoint_name, model_no_ddp, optimizer)
+                    if checkpointer is not None:
+                        checkpointer.save(checkpoint_name, model_no_ddp, optimizer)
+                    else:
+                        save_checkpoint(checkpoint_name, model_no_ddp, optimizer)
 
 
         # END OF EPOCH
-        if is_dist_avail_and_initialized():
-            dist.barrier()
         if cfg.optimizer.use_scheduler:
-            if is_master():
-                val_loss_tensor = torch.tensor(val_loss_mean, device=device)
-            else:
-                val_loss_tensor = torch.tensor(0, dtype=torch.float64, device=device)
-            dist.broadcast(val_loss_tensor, src=0)
+            # The val loss only changes on validation epochs, it is shared then and reused in between
+            if validation_epoch:
+                # Zero on all other ranks, so the sum is the validation loss of the master
+                val_loss_tensor = torch.tensor(val_loss_mean if is_master() else 0.0, dtype=torch.float64,
+                                               device=device)
+                if is_dist_avail_and_initialized():
+                    dist.all_reduce(val_loss_tensor, op=dist.ReduceOp.SUM)
             scheduler.step(val_loss_tensor)
+    if checkpointer is not None:
+        checkpointer.close()
     cleanup()
 
 
+def register_compression_hook(model, compression):
+    '''
+    Halves the allreduce bandwidth by casting the gradient buckets to a 16 bit dtype for the communication.
+    :param model: DDP wrapped model
+    :param compression: 'fp16' or 'bf16', bf16 falls back to fp16 on gpus without bf16 support
+    '''
+    from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+    assert compression in ['fp16', 'bf16']
+    if compression == 'bf16' and not torch.cuda.is_bf16_supported():
+        print("bf16 is not supported on this gpu, compressing gradients to fp16 instead")
+        compression = 'fp16'
+    if compression == 'bf16':
+        model.register_comm_hook(state=None, hook=default_hooks.bf16_compress_hook)
+    else:
+        model.register_comm_hook(state=None, hook=default_hooks.fp16_compress_hook)
+
+
 if __name__ == "__main__":
     main()
@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from utils.utils import AverageMeter, log_train_metrics, log_train_classification, log_val_metrics, log_val_classification, save_checkpoint
+from utils.utils import AverageMeter, normalize_uint8_input, autocast_kwargs, log_train_metrics, log_train_classification, log_val_metrics, log_val_classification, save_checkpoint
 from sklearn.metrics import r2_score, accuracy_score, top_k_accuracy_score
 import time
 from torch.cuda.amp import GradScaler
@@ -92,8 +92,8 @@ def train_and_validate(model, train_data_loader, val_data_loader, cfg, experimen
 
     use_half_prec = cfg.performance.half_precision
 
-    # Initialize GradScaler for autocasting
-    scaler = GradScaler(enabled=use_half_prec)
+    # Initialize GradScaler for autocasting, only needed for fp16
+    scaler = GradScaler(enabled=use_half_prec and cfg.performance.half_precision_dtype == 'fp16')
 
     print('Model parameters: {}'.format(sum(p.numel() for p in model.parameters() if p.requires_grad)))
 
@@ -147,7 +147,7 @@ def train_and_validate(model, train_data_loader, val_data_loader, cfg, experimen
             
             # Move input to CUDA if available
             if cuda_available:
-                if len(inputs_t) > 1:
+                if isinstance(inputs_t, list):
                     for p, inp in enumerate(inputs_t):
                         if not torch.isfinite(inp).all():
                             raise ValueError('Input from dataloader not finite')
@@ -159,13 +159,18 @@ def train_and_validate(model, train_data_loader, val_data_loader, cfg, experimen
                 if goal_type == 'classification':
                     targets_t = targets_t.long().squeeze()
                 targets_t = targets_t.to(device, non_blocking=True)
+            # On the gpu if available, uint8 input with normalize_on_gpu also has to be normalized without one
+            if isinstance(inputs_t, list):
+                inputs_t = [normalize_uint8_input(inp) for inp in inputs_t]
+            else:
+                inputs_t = normalize_uint8_input(inputs_t)
 
 
 
             # Do forward and backwards pass
 
             # Get model train output and train loss
-            with autocast(enabled=use_half_prec):
+            with autocast(enabled=use_half_prec, **autocast_kwargs(cfg)):
                 outputs_t = model(inputs_t)
                 if goal_type == 'ordinal-regression':
                     loss_t = criterion(outputs_t, targets_t, model.module.thresholds)
@@ -255,7 +260,7 @@ def train_and_validate(model, train_data_loader, val_data_loader, cfg, experimen
 
                 # Move input to CUDA if available
                 if cuda_available:
-                    if len(inputs_v) > 1:
+                    if isinstance(inputs_v, list):
                         for p, inp in enumerate(inputs_v):
                             inputs_v[p] = inp.to(device, non_blocking=True)
                     else:
@@ -263,10 +268,14 @@ def train_and_validate(model, train_data_loader, val_data_loader, cfg, experimen
                     if goal_type == 'classification':
                         targets_v = targets_v.long().squeeze()
                     targets_v = targets_v.to(device, non_blocking=True)
+                if isinstance(inputs_v, list):
+                    inputs_v = [normalize_uint8_input(inp) for inp in inputs_v]
+                else:
+                    inputs_v = normalize_uint8_input(inputs_v)
 
                 with torch.no_grad():
                     # Get model validation output and validation loss
-                    with autocast(enabled=use_half_prec):
+                    with autocast(enabled=use_half_prec, **autocast_kwargs(cfg)):
                         outputs_v = model(inputs_v)
                         if goal_type == 'ordinal-regression':
                             loss_v = criterion(outputs_v, targets_v, model.module.thresholds)
@@ -4,6 +4,7 @@ import torch
 import torch.distributed as dist
 import numpy as np
 import os
+import datetime
 import utils.utils
 
 
@@ -18,6 +19,9 @@ class AverageMeterDDP(object):
             self.step = dist.get_world_size()
         else:
             self.step = 1
+        # Allocated on the first update, meters in an AverageMeterGroupDDP never reduce on their own
+        self.host_buffer = None
+        self.device_buffer = None
 
     def reset(self):
         self.val = np.zeros(self.n_classes)
@@ -27,38 +31,130 @@ class AverageMeterDDP(object):
 
     def update(self, val):
         if is_dist_avail_and_initialized():
-            t_val = torch.tensor(val, dtype=torch.float64, device='cuda')
-            dist.barrier()
-            dist.all_reduce(t_val)
-            val = t_val.cpu().numpy()
-        self.count += self.step
-        for i in range(0, self.n_classes):
-            self.val[i] = val[i]
-            self.sum[i] += val[i]
-            self.avg[i] = self.sum[i] / self.count
+            if self.host_buffer is None:
+                self.host_buffer, self.device_buffer = create_reduce_buffers(self.n_classes)
+            self.host_buffer.numpy()[:] = val
+            val = all_reduce_buffers(self.host_buffer, self.device_buffer)
+        self.add(val, self.step)
+
+    def add(self, val, n):
+        '''
+        Adds values that are already summed over ranks.
+        :param val: Values summed over n ranks, one per class
+        :param n: Number of ranks in the sum
+        '''
+        self.count += n
+        # Copied, val can be a view of a reused reduce buffer
+        self.val = np.array(val, dtype=np.float64)
+        self.sum += self.val
+        self.avg = self.sum / self.count
+
+
+class AverageMeterGroupDDP(object):
+    '''
+    Updates several AverageMeterDDP with a single all_reduce instead of one per meter.
+    '''
+    def __init__(self, **meters):
+        self.meters = meters
+        if is_dist_avail_and_initialized():
+            size = sum(meter.n_classes + 1 for meter in self.meters.values())
+            self.host_buffer, self.device_buffer = create_reduce_buffers(size)
+
+    def update(self, values):
+        '''
+        :param values: Dict from meter name to its list of values. Meters left out on a rank are still part of the
+        all_reduce, so every rank issues the same collective, but only get the values of the ranks that had them.
+        '''
+        # Values of every meter followed by a flag counting the ranks that provided them
+        flat = []
+        for name, meter in self.meters.items():
+            if name in values:
+                flat.extend(values[name])
+                flat.append(1.0)
+            else:
+                flat.extend([0.0] * (meter.n_classes + 1))
+        if is_dist_avail_and_initialized():
+            self.host_buffer.numpy()[:] = flat
+            flat = all_reduce_buffers(self.host_buffer, self.device_buffer)
+        else:
+            flat = np.asarray(flat, dtype=np.float64)
+        offset = 0
+        for meter in self.meters.values():
+            n = int(round(flat[offset + meter.n_classes]))
+            if n > 0:
+                meter.add(flat[offset:offset + meter.n_classes], n)
+            offset += meter.n_classes + 1
+
+
+def create_reduce_buffers(size):
+    '''
+    Allocates a pinned host buffer and a cuda buffer to be reused for every all_reduce of a meter.
+    :param size: Number of float64 values
+    :return: The host buffer and the device buffer
+    '''
+    host_buffer = torch.zeros(size, dtype=torch.float64, pin_memory=True)
+    device_buffer = torch.zeros(size, dtype=torch.float64, device='cuda')
+    return host_buffer, device_buffer
+
+
+def all_reduce_buffers(host_buffer, device_buffer):
+    '''
+    Sums the values in host_buffer over all ranks, through device_buffer.
+    :return: Numpy view of host_buffer with the summed values, valid until the buffer is used again
+    '''
+    device_buffer.copy_(host_buffer, non_blocking=True)
+    dist.all_reduce(device_buffer)
+    # Blocking, the result is read right away
+    host_buffer.copy_(device_buffer)
+    return host_buffer.numpy()
+
+
+def is_torchrun():
+    '''
+    True if the process was started by torchrun (torch.distributed.run) or by torch.distributed.launch --use_env,
+    which set the ranks in the environment.
+    '''
+    return 'LOCAL_RANK' in os.environ
 
 
 def prepare_ddp(config):
     '''
     Global settings for DDP. NCCL is optimal for cuda usage.
     '''
-    utils.utils.update_cfg(config, key='world_size', val=torch.cuda.device_count())
+    if is_torchrun():
+        world_size = int(os.environ['WORLD_SIZE'])
+        # torch.distributed.launch in torch < 1.9 does not set LOCAL_WORLD_SIZE, it starts one process per gpu
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', torch.cuda.device_count()))
+    else:
+        world_size = torch.cuda.device_count()
+        local_world_size = world_size
+    utils.utils.update_cfg(config, key='world_size', val=world_size)
+    utils.utils.update_cfg(config, key='local_world_size', val=local_world_size)
     utils.utils.update_cfg(config, key='dist_backend', val='nccl')
     utils.utils.update_cfg(config, key='dist_url', val='env://')
 
 
+def create_setup_group(config):
+    '''
+    Gloo process group for waiting while the master prepares the data sets. That can take longer than the
+    collective timeout of the default NCCL group, so this group uses performance.ddp_setup_timeout_h instead.
+    '''
+    return dist.new_group(backend='gloo', timeout=datetime.timedelta(hours=config.performance.ddp_setup_timeout_h))
+
+
 def init_distributed_mode(config):
     '''
-    Starts a DDP process group on localhost
+    Starts a DDP process group. config.rank is the global rank, config.local_rank the gpu on this node.
     '''
-    os.environ['MASTER_ADDR'] = 'localhost'
-    os.environ['MASTER_PORT'] = '12355'
-    torch.cuda.set_device(config.rank)
+    # Already set when started by torchrun
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '12355')
+    torch.cuda.set_device(config.local_rank)
     torch.distributed.init_process_group(
         backend=config.dist_backend, init_method=config.dist_url,
         world_size=config.world_size, rank=config.rank)
     if is_dist_avail_and_initialized():
-        print("Started DDP process group at rank {} with world size {} on localhost \n".format(get_rank(), dist.get_world_size()))
+        print("Started DDP process group at rank {} with world size {} on {} \n".format(get_rank(), dist.get_world_size(), os.environ['MASTER_ADDR']))
     #setup_for_distributed(is_master())
 
 
@@ -117,22 +213,28 @@ class DistributedWeightedSampler(torch.utils.data.DistributedSampler):
         # Each sampler keep weights for entire dataset but only use/update the indices received from the
         # distributed sampler
         self.weights = torch.as_tensor(len(dataset) * [1.0], dtype=torch.double)
+        # Reseeded with the epoch in every __iter__
+        self.generator = torch.Generator()
 
     def __iter__(self):
         iter_indices = super(DistributedWeightedSampler, self).__iter__()
-        indices = list(iter_indices)
+        indices = torch.as_tensor(list(iter_indices), dtype=torch.long)
 
-        weights = torch.tensor([self.weights[idx] for idx in indices])
+        weights = self.weights.index_select(0, indices)
+        # Until the first weights are updated sampling is uniform, use the shuffled indices of the distributed
+        # sampler directly
+        if torch.all(weights == 1.0):
+            # Iterates the numpy view of the index tensor, without building a list of python ints first
+            return iter(indices.numpy())
 
-        g = torch.Generator()
-        g.manual_seed(self.epoch)
+        self.generator.manual_seed(self.epoch)
 
         weight_indices = torch.multinomial(
-            weights, self.num_samples, self.replacement, generator=g)
-        indices = torch.tensor(indices)[weight_indices]
+            weights, self.num_samples, self.replacement, generator=self.generator)
+        indices = indices[weight_indices]
 
-        iter_indices = iter(indices.tolist())
-        return iter_indices
+        # Numpy view again, see the uniform case
+        return iter(indices.numpy())
 
     def __len__(self):
         return self.num_samples
\ No newline at end of file
@@ -1,9 +1,13 @@
 import csv
 import os
+import queue
+import threading
+import psutil
 import torch
 from torch.utils.data import DataLoader, WeightedRandomSampler, RandomSampler, DistributedSampler
 from models import custom_cnn, resnext, i3d_bert, multi_stream
 from data.npy_dataset import NPYDataset
+from data.data_augmentations import init_worker
 from data.multi_stream_dataset import MultiStreamDataset
 from omegaconf import OmegaConf
 from omegaconf.omegaconf import open_dict
@@ -186,16 +190,110 @@ def create_train_loader(cfg, train_d_set):
         t_sampler = RandomSampler(train_d_set)
     train_data_loader = DataLoader(train_d_set, batch_size=cfg.data_loader.batch_size_train,
                                    num_workers=cfg.data_loader.n_workers, drop_last=cfg.data_loader.drop_last,
-                                   sampler=t_sampler)
+                                   sampler=t_sampler, pin_memory=use_pin_memory(cfg),
+                                   persistent_workers=use_persistent_workers(cfg), worker_init_fn=init_worker,
+                                   **prefetch_kwargs(cfg))
     return train_data_loader
 
 
 def create_val_loader(cfg, val_d_set):
     val_data_loader = DataLoader(val_d_set, batch_size=cfg.data_loader.batch_size_eval,
-                                 num_workers=cfg.data_loader.n_workers, drop_last=cfg.data_loader.drop_last)
+                                 num_workers=cfg.data_loader.n_workers, drop_last=cfg.data_loader.drop_last,
+                                 pin_memory=use_pin_memory(cfg), persistent_workers=use_persistent_workers(cfg),
+                                 worker_init_fn=init_worker, **prefetch_kwargs(cfg))
     return val_data_loader
 
 
+def normalize_uint8_input(inputs):
+    '''
+    Normalizes uint8 input into the range -1:1 on the device it is on. Datasets send uint8 input when
+    transforms.normalize_on_gpu is set, any other input is already normalized and returned unchanged.
+    '''
+    if inputs.dtype == torch.uint8:
+        return inputs.float().mul_(2 / 255.).sub_(1)
+    return inputs
+
+
+def autocast_kwargs(cfg):
+    '''
+    Extra autocast arguments for performance.half_precision_dtype. Empty for fp16, the autocast default,
+    so torch versions without the dtype argument still work.
+    '''
+    if cfg.performance.half_precision_dtype == 'bf16':
+        return {'dtype': torch.bfloat16}
+    return {}
+
+
+def memory_format(cfg):
+    '''
+    Memory format for the model input, channels_last_3d with performance.channels_last to match the model layout
+    set in train_and_val.
+    '''
+    if cfg.performance.channels_last:
+        return torch.channels_last_3d
+    return torch.preserve_format
+
+
+def use_pin_memory(cfg):
+    '''
+    Pinned host memory only pays off when batches are copied to a cuda device, without one it is just
+    extra page-locked allocations. All our datasets return tensors or lists of tensors after the default
+    collate so pinning itself works for every data type.
+    '''
+    if cfg.data_loader.pin_memory and not torch.cuda.is_available():
+        print('pin_memory is enabled but cuda is not available, disabling it')
+        return False
+    return cfg.data_loader.pin_memory
+
+
+def use_persistent_workers(cfg):
+    '''
+    Keeps the DataLoader workers alive between epochs instead of re-creating them every epoch.
+    PyTorch only allows this when the loader actually uses worker processes.
+    '''
+    return cfg.data_loader.persistent_workers and cfg.data_loader.n_workers > 0
+
+
+def prefetch_kwargs(cfg):
+    '''
+    DataLoader prefetch_factor argument. PyTorch rejects a non-default prefetch_factor without worker processes,
+    so it is only passed when the loader uses them.
+    '''
+    if cfg.data_loader.n_workers > 0:
+        return {'prefetch_factor': cfg.data_loader.prefetch_factor}
+    return {}
+
+
+def sample_nbytes(data_set):
+    '''
+    Size of the input of one sample as it leaves the workers, in its real dtype (uint8 with normalize_on_gpu).
+    '''
+    inputs = data_set[0][0]
+    if not isinstance(inputs, list):
+        inputs = [inputs]
+    return sum(inp.nbytes for inp in inputs)
+
+
+def check_prefetch_memory(cfg, train_d_set, val_d_set=None, n_train_loaders=1):
+    '''
+    Warns if the batches buffered by the DataLoader workers (prefetch_factor * n_workers per loader)
+    would not fit into the available RAM. Lower data_loader.prefetch_factor if this triggers.
+    Call it once per node, it reads one sample of each data set.
+    :param n_train_loaders: Number of processes on this node with a train loader, the ranks in DDP
+    '''
+    if cfg.data_loader.n_workers == 0:
+        return
+    batches = cfg.data_loader.prefetch_factor * cfg.data_loader.n_workers
+    buffered_bytes = batches * cfg.data_loader.batch_size_train * sample_nbytes(train_d_set) * n_train_loaders
+    if val_d_set is not None:
+        buffered_bytes += batches * cfg.data_loader.batch_size_eval * sample_nbytes(val_d_set)
+    available_bytes = psutil.virtual_memory().available
+    if buffered_bytes > available_bytes:
+        print('Warning: DataLoader workers may buffer {:.1f} GB of batches but only {:.1f} GB of RAM is available. '
+              'Consider lowering data_loader.prefetch_factor or data_loader.n_workers'
+              .format(buffered_bytes / 1e9, available_bytes / 1e9))
+
+
 def create_data_sets(cfg):
     if cfg.data.type == 'multi-stream':
         dataset_c = MultiStreamDataset
@@ -263,13 +361,101 @@ def save_checkpoint(save_file_path, model, optimizer):
     torch.save(save_states, save_file_path)
 
 
-def save_checkpoint(save_file_path, model, optimizer):
-    if hasattr(model, 'module'):
-        model_state_dict = model.module.state_dict()
-    else:
-        model_state_dict = model.state_dict()
-    save_states = {
-        'model': model_state_dict,
-        'optimizer': optimizer.state_dict(),
-    }
-    torch.save(save_states, save_file_path)
\ No newline at end of file
+class AsyncCheckpointer(object):
+    '''
+    Saves checkpoints like save_checkpoint, but only the copy of the states to cpu is done in the calling thread.
+    One long lived background thread writes the queued checkpoints to disk so training can continue meanwhile.
+    Call close before exiting.
+    '''
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_queued, daemon=True)
+        self.thread.start()
+        # Shapes and dtypes of the state tensors and the cpu buffers they are copied into, reused between saves
+        self.plan = None
+        self.buffers = None
+
+    def save(self, save_file_path, model, optimizer):
+        if hasattr(model, 'module'):
+            model_state_dict = model.module.state_dict()
+        else:
+            model_state_dict = model.state_dict()
+        save_states = {
+            'model': model_state_dict,
+            'optimizer': optimizer.state_dict(),
+        }
+        # The buffers are reused, so the previous checkpoint has to be written first
+        self.queue.join()
+        tensors = flatten_tensors(save_states)
+        plan = [(t.shape, t.dtype) for t in tensors]
+        if plan != self.plan:
+            pin = torch.cuda.is_available()
+            self.buffers = [torch.empty(shape, dtype=dtype, pin_memory=pin) for shape, dtype in plan]
+            self.plan = plan
+        for buffer, t in zip(self.buffers, tensors):
+            buffer.copy_(t, non_blocking=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.queue.put((save_file_path, replace_tensors(save_states, iter(self.buffers))))
+
+    def write_queued(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                write_checkpoint(*item)
+            except Exception as e:
+                print("Failed to save checkpoint {} with exception: {}".format(item[0], e))
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        '''
+        Waits for all queued checkpoints to be written and stops the background thread.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+
+
+def write_checkpoint(save_file_path, save_states):
+    '''
+    Writes to a temporary file next to the checkpoint and then renames it, so a crash during
+    the write never leaves a broken checkpoint behind.
+    '''
+    # A normal open, so the checkpoint gets the same (umask) permissions as one written by torch.save
+    tmp_path = save_file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(save_states, f)
+    os.replace(tmp_path, save_file_path)
+
+
+def flatten_tensors(obj):
+    '''
+    Returns all tensors in a (state dict) structure as a list, in the order replace_tensors visits them.
+    '''
+    if torch.is_tensor(obj):
+        return [obj]
+    if isinstance(obj, dict):
+        return [t for v in obj.values() for t in flatten_tensors(v)]
+    if isinstance(obj, (list, tuple)):
+        return [t for v in obj for t in flatten_tensors(v)]
+    return []
+
+
+def replace_tensors(obj, tensors):
+    '''
+    Rebuilds a (state dict) structure with its tensors replaced, in order, by the ones from the tensors iterator.
+    '''
+    if torch.is_tensor(obj):
+        return next(tensors)
+    if isinstance(obj, dict):
+        new_obj = type(obj)((k, replace_tensors(v, tensors)) for k, v in obj.items())
+        # Module state dicts carry their version metadata as an attribute
+        if hasattr(obj, '_metadata'):
+            new_obj._metadata = obj._metadata
+        return new_obj
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(replace_tensors(v, tensors) for v in obj)
+    return obj